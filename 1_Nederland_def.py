@@ -1,54 +1,115 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import io
 
-def clean_csv(file):
-    lines = file.getvalue().decode('utf-8').splitlines()
-    cleaned_lines = [line.strip().strip('"') for line in lines]
-    return "\n".join(cleaned_lines)
-    
+# With copy-on-write the column selections, filters and renames below share data instead of copying every column
+pd.options.mode.copy_on_write = True
+
+MAIN_STRING_COLUMNS = ["Name", "Created at", "Fulfillment Status", "Fulfilled at", "Lineitem name", "Lineitem sku", "Billing Name", "Billing Street", "Billing Country"]
+MAIN_COLUMNS = MAIN_STRING_COLUMNS + ["Lineitem quantity"]
+MAIN_COLUMN_TYPES = {**{name: pa.string() for name in MAIN_STRING_COLUMNS}, "Lineitem quantity": pa.int64()}
+REFERENCE_COLUMNS = ["SKU", "Alcohol Percentage"]
+DATE_FORMAT = 'ISO8601'
+NUMBER_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+def clean_csv(content, columns):
+    # Every line of the reference file is wrapped in quotes, so first read it as whole lines and trim the quotes from the line ends
+    lines = pv.read_csv(
+        pa.BufferReader(content),
+        read_options=pv.ReadOptions(column_names=['line']),
+        parse_options=pv.ParseOptions(delimiter='\x1f', quote_char=False),
+        convert_options=pv.ConvertOptions(column_types={'line': pa.string()}),
+    ).column('line')
+    lines = pc.utf8_trim(pc.utf8_trim_whitespace(lines), characters='"')
+    lines = pc.binary_join_element_wise(lines, '', '\n').combine_chunks()
+    cleaned = lines.buffers()[2].slice(0, pc.sum(pc.binary_length(lines)).as_py())
+    # The cleaned catalogue is small, pandas parses it with the same tolerance as before (quoted fields, short rows, blank lines)
+    check = pd.read_csv(pa.BufferReader(cleaned), usecols=columns, dtype=str)
+    return pa.Table.from_pandas(check, preserve_index=False)
+
+def read_main_csv(content):
+    table = pv.read_csv(
+        pa.BufferReader(content),
+        # Shopify exports have quoted multi-line cells such as notes and addresses
+        parse_options=pv.ParseOptions(newlines_in_values=True),
+        convert_options=pv.ConvertOptions(column_types=MAIN_COLUMN_TYPES, include_columns=MAIN_COLUMNS, strings_can_be_null=True),
+    )
+    return table
+
+# Streamlit reruns the script on every interaction, the parsed files are cached on their content. Only the latest uploads are useful, so the cache is kept small
+@st.cache_data(max_entries=2)
+def load_main_file(content):
+    table = read_main_csv(content)
+    # Missing statuses compare as null in Arrow, those order lines are kept
+    not_restocked = pc.fill_null(pc.not_equal(table.column('Fulfillment Status'), 'restocked'), True)
+    table = table.filter(not_restocked) #toegevoegd omdat gecancelde orders wegmoeten
+    # Renaming columns and preparing the data, the SKU suffix is stripped in Arrow before converting to pandas
+    sku_index = table.schema.get_field_index('Lineitem sku')
+    table = table.set_column(sku_index, 'SKU', pc.replace_substring_regex(table.column(sku_index), r"(-\d+|[A-Z])$", ""))
+    # Keep the text columns Arrow-backed so the string operations below run as Arrow kernels
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+@st.cache_data(max_entries=2)
+def load_reference_file(content):
+    reference = clean_csv(content, REFERENCE_COLUMNS)
+    # Normalise the percentages ('13,5 %' becomes '13.5') and parse them to floats in Arrow
+    percentage_index = reference.schema.get_field_index('Alcohol Percentage')
+    percentages = pc.replace_substring_regex(reference.column(percentage_index), r'[%\s\x{00A0}]', '')
+    percentages = pc.replace_substring(percentages, ',', '.')
+    percentages = pc.if_else(pc.equal(percentages, ''), pa.scalar(None, pa.string()), percentages)
+    # A value that is still not a number would silently drop out of both excise totals, so name the SKUs instead
+    invalid = pc.invert(pc.fill_null(pc.match_substring_regex(percentages, NUMBER_PATTERN), True))
+    if pc.any(invalid).as_py():
+        invalid_skus = reference.filter(invalid).column('SKU').to_pylist()
+        raise ValueError(f"Alcohol Percentage is not a number for SKU(s): {', '.join(map(str, invalid_skus))}")
+    percentages = pc.cast(percentages, pa.float64())
+    reference = reference.set_column(percentage_index, 'Alcohol Percentage', percentages)
+    # Looking up the alcohol percentage per SKU, a dict map is much cheaper than a merge for this one-to-one lookup
+    return dict(zip(reference.column('SKU').to_pylist(), reference.column('Alcohol Percentage').to_pylist()))
+
 def process_files(main_file, reference_file, start_date, end_date):
     # Load main data file
-    data = pd.read_csv(main_file)
-    data = data[data['Fulfillment Status'] != 'restocked'] #toegevoegd omdat gecancelde orders wegmoeten
-    # Renaming columns and preparing the data
-    data = data.rename(columns={"Lineitem sku": "SKU"})
-    data['SKU'] = data['SKU'].str.replace(r"(-\d+|[A-Z])$", "", regex=True)
+    data = load_main_file(main_file.getvalue())
     
     # Load reference data file
-    reference_file_content = clean_csv(reference_file)
-    check = pd.read_csv(io.StringIO(reference_file_content))
-    check = check.drop_duplicates()
-    # Merging data with reference data
-    data = pd.merge(data, check[['SKU', 'Alcohol Percentage']], on='SKU', how='left')
+    lookup = load_reference_file(reference_file.getvalue())
     
     # Filling missing data
-    data['Fulfilled at'] = data['Fulfilled at'].ffill()
-    data['Billing Country'] = data['Billing Country'].ffill()
-    data['Billing Name'] = data['Billing Name'].ffill()
-    data['Billing Street'] = data['Billing Street'].ffill()
+    fill_columns = ['Fulfilled at', 'Billing Country', 'Billing Name', 'Billing Street']
+    data[fill_columns] = data[fill_columns].ffill()
     
-    # Filtering data for specific conditions
-    df = data[~data['Billing Country'].isin(['NL', 'FR'])]
-    selected_columns = ["Name", "Created at", "Fulfilled at", "Lineitem quantity", "Lineitem name", "Billing Name", "Billing Street", "Alcohol Percentage", "Billing Country"]
+    # Remove timezone offset and then convert to datetime, ISO8601 keeps pandas on its fast path and accepts both a space and a T separator
+    data['Fulfilled at'] = pd.to_datetime(data['Fulfilled at'].str.slice(0, 19), format=DATE_FORMAT, errors='coerce')
+    
+    # Filtering data for specific conditions in one pass, before any of the per-row work below
+    keep = ~data['Billing Country'].isin(['NL', 'FR']) & (data['Fulfilled at'] >= start_date) & (data['Fulfilled at'] <= end_date)
+    df = data[keep]
+    selected_columns = ["Name", "Created at", "Fulfilled at", "Lineitem quantity", "Lineitem name", "Billing Name", "Billing Street", "SKU", "Billing Country"]
     new_df = df[selected_columns]
     new_df = new_df.rename(columns={"Name": "Invoice/order", "Created at": "Invoice date", "Fulfilled at": "Delivery date","Lineitem name": "Product name", "Lineitem quantity": "Number of sold items", "Billing Name": "Name of client", "Billing Street": "Address details", "Billing Country": "Country"  })
     
-    # Remove timezone offset and then convert to datetime
-    new_df['Invoice date'] = pd.to_datetime(new_df['Invoice date'].str.slice(0, 19), errors='coerce')
-    new_df['Delivery date'] = pd.to_datetime(new_df['Delivery date'].str.slice(0, 19), errors='coerce')
+    new_df['Invoice date'] = pd.to_datetime(new_df['Invoice date'].str.slice(0, 19), format=DATE_FORMAT, errors='coerce')
+    new_df['Alcohol Percentage'] = new_df['SKU'].map(lookup).astype('float64')
+    
+    # The other columns follow from the order, the product name or the SKU, so these keys identify a line item
+    new_df = new_df.drop_duplicates(subset=['Invoice/order', 'Product name', 'Number of sold items', 'Alcohol Percentage'])
     
     new_df["Plato percentage"] = 0
     #new_df['Last Part'] = new_df['Product name'].str.split().str[-2:].str.join(' ')
-    new_df['Content'] = new_df['Product name'].str.extract(r'(\d+)(?!.*\d)').astype(float).astype('Int64')
+    new_df['Content'] = pd.to_numeric(new_df['Product name'].str.extract(r'(\d+)\D*$', expand=False), dtype_backend='numpy_nullable').astype('Int64')
     new_df["Total content"] = new_df["Content"]*new_df["Number of sold items"]
 
-    filtered_df = new_df[(new_df['Delivery date'] >= start_date) & (new_df['Delivery date'] <= end_date)]
-    final_data = filtered_df[['Invoice/order', 'Invoice date', 'Delivery date', 'Name of client', 'Address details', 'Product name', 'Number of sold items', 'Content', 'Total content', 'Alcohol Percentage', 'Plato percentage', 'Country']]
-    final_data = final_data.drop_duplicates()
+    final_data = new_df[['Invoice/order', 'Invoice date', 'Delivery date', 'Name of client', 'Address details', 'Product name', 'Number of sold items', 'Content', 'Total content', 'Alcohol Percentage', 'Plato percentage', 'Country']]
 
-    total_content_sum_lower = final_data[final_data['Alcohol Percentage'] <= 8.5]['Total content'].sum()
-    total_content_sum_higher = final_data[final_data['Alcohol Percentage'] > 8.5]['Total content'].sum()
+    # Both threshold sums in one pass: bucket 0 is <= 8.5%, bucket 1 is > 8.5% and rows without a known percentage go to bucket 2
+    alcohol_percentage = final_data['Alcohol Percentage'].to_numpy(dtype='float64')
+    total_content = final_data['Total content'].to_numpy(dtype='float64', na_value=0.0)
+    bucket = (alcohol_percentage > 8.5) + 2 * np.isnan(alcohol_percentage)
+    total_content_sum_lower, total_content_sum_higher, _ = np.bincount(bucket, weights=total_content, minlength=3)
     
     summary_df = pd.DataFrame({
         'Invoice/order': ['Total Content <= 8.5%', 'Total Content > 8.5%'],
@@ -81,7 +142,7 @@ if st.button('Download bestand'):
             st.write(result_df)
             # Convert DataFrame to Excel in memory
             towrite = io.BytesIO()
-            result_df.to_excel(towrite, index=False, engine='openpyxl')  # write to BytesIO buffer
+            result_df.to_excel(towrite, index=False, engine='xlsxwriter')  # write to BytesIO buffer
             towrite.seek(0)  # rewind the buffer
             
             formatted_start_time = start_time.strftime('%Y%m%d')